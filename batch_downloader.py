@@ -1,26 +1,28 @@
 import os
 import argparse
-import subprocess
 import sys
-from datetime import datetime
-from dateutil.relativedelta import relativedelta
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from pathlib import Path
 
+import pandas as pd
+
+from planet_downloader import MAX_WORKERS, available_cpus, create_session, positive_int, run
+
+
+# Per-process connection pool for --jobs > 1, set up once by init_worker()
+_worker_session = None
+
 
 def parse_month(month_str):
-    """Parse month string YYYY_MM to datetime object"""
+    """Parse month string YYYY_MM to a monthly pandas Period"""
     try:
         year, month = month_str.split('_')
-        return datetime(int(year), int(month), 1)
+        return pd.Period(f"{int(year):04d}-{int(month):02d}", freq="M")
     except Exception as e:
         raise ValueError(f"Invalid month format: {month_str}. Expected format: YYYY_MM (e.g., 2020_01)")
 
 
-def format_month(dt):
-    """Format datetime to YYYY_MM string"""
-    return dt.strftime("%Y_%m")
-
-
 def generate_month_range(start_month, end_month):
     """Generate list of months between start and end (inclusive)"""
     start = parse_month(start_month)
@@ -29,42 +31,121 @@ def generate_month_range(start_month, end_month):
     if start > end:
         raise ValueError(f"Start month ({start_month}) must be before or equal to end month ({end_month})")
     
-    months = []
-    current = start
-    while current <= end:
-        months.append(format_month(current))
-        current += relativedelta(months=1)
-    
-    return months
-
-
-def run_downloader(aoi_path, month, api_key, zoom, save_dir, output_name=None):
-    cmd = [
-        sys.executable,
-        "planet_downloader.py",
-        "--aoi", aoi_path,
-        "--month", month,
-        "--api-key", api_key,
-        "--zoom", str(zoom),
-        "--save-dir", save_dir
-    ]
+    return pd.period_range(start, end, freq="M").strftime("%Y_%m").tolist()
 
-    if output_name:
-        cmd.extend(["--output-name", output_name])
 
+def run_downloader(aoi_path, month, api_key, zoom, save_dir, output_name=None,
+                   session=None, max_workers=MAX_WORKERS, cache_dir=None,
+                   revalidate_cache=False, decode_workers=None):
     print(f"\n{'='*60}")
     print(f"Downloading: {month}")
     print(f"{'='*60}")
 
     try:
-        result = subprocess.run(cmd, check=True, capture_output=True, text=True)
-        print(result.stdout)
-        return True, None
-    except subprocess.CalledProcessError as e:
-        error_msg = f"Error downloading {month}:\n{e.stderr}"
+        output = run(
+            aoi=aoi_path,
+            month=month,
+            api_key=api_key,
+            zoom=zoom,
+            save_dir=save_dir,
+            output_name=output_name,
+            session=session,
+            max_workers=max_workers,
+            cache_dir=cache_dir,
+            revalidate_cache=revalidate_cache,
+            decode_workers=decode_workers,
+        )
+    except Exception as e:
+        error_msg = f"Error downloading {month}:\n{e}"
         print(error_msg, file=sys.stderr)
         return False, error_msg
 
+    if output is None:
+        error_msg = f"Error downloading {month}: no tiles downloaded"
+        print(error_msg, file=sys.stderr)
+        return False, error_msg
+
+    return True, None
+
+
+def init_worker(max_workers):
+    """Open a connection pool once per worker process"""
+    global _worker_session
+    # Worker stdout is block-buffered when it is a pipe (e.g. container
+    # logs); flush per line so progress and errors show up as they happen.
+    sys.stdout.reconfigure(line_buffering=True)
+    _worker_session = create_session(max_workers)
+
+
+def run_downloader_in_worker(**kwargs):
+    return run_downloader(session=_worker_session, **kwargs)
+
+
+def run_downloader_parallel(months, args, results):
+    """Download months concurrently, one process per month up to args.jobs"""
+    # Share the CPUs between the month processes so each one's decode and
+    # GeoTIFF encoding threads don't oversubscribe the machine.
+    decode_workers = max(1, available_cpus() // args.jobs)
+
+    # Spawn fresh interpreters so each worker initialises its own GDAL/PROJ
+    # state instead of inheriting the parent's through fork().
+    with ProcessPoolExecutor(
+        max_workers=args.jobs,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(args.max_workers,),
+    ) as executor:
+        def submit(month):
+            return executor.submit(
+                run_downloader_in_worker,
+                aoi_path=args.aoi,
+                month=month,
+                api_key=args.api_key,
+                zoom=args.zoom,
+                save_dir=args.save_dir,
+                max_workers=args.max_workers,
+                cache_dir=args.cache_dir,
+                revalidate_cache=args.revalidate_cache,
+                decode_workers=decode_workers,
+            )
+
+        # Submit months lazily, keeping at most args.jobs in flight: the
+        # executor pre-queues extra work items that cancel() can't stop, so
+        # submitting everything up front would keep starting new months
+        # after a failure.
+        remaining = iter(months)
+        futures = {}
+        for month in remaining:
+            futures[submit(month)] = month
+            if len(futures) >= args.jobs:
+                break
+
+        stopping = False
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                month = futures.pop(future)
+                try:
+                    success, error = future.result()
+                except Exception as e:
+                    success, error = False, f"Error downloading {month}:\n{e}"
+
+                if success:
+                    results["success"].append(month)
+                else:
+                    results["failed"].append((month, error))
+                    if not args.continue_on_error and not stopping:
+                        print(f"\nStopping due to error. Use --continue-on-error to continue on failures.")
+                        # Months already running are allowed to finish
+                        stopping = True
+
+                if not stopping:
+                    next_month = next(remaining, None)
+                    if next_month is not None:
+                        futures[submit(next_month)] = next_month
+
+    results["success"].sort()
+    results["failed"].sort()
 
 
 def main():
@@ -87,6 +168,10 @@ Examples:
   # Continue on error (don't stop if one month fails)
   python batch_downloader.py --aoi area.geojson --start 2020_01 --end 2020_12 \\
     --api-key YOUR_KEY --continue-on-error
+
+  # Keep downloaded tiles so a rerun only fetches the ones that failed
+  python batch_downloader.py --aoi area.geojson --start 2020_01 --end 2020_12 \\
+    --api-key YOUR_KEY --continue-on-error --cache-dir ./tile_cache
         """
     )
     
@@ -102,6 +187,14 @@ Examples:
                        help="Zoom level for tiles (default: 15)")
     parser.add_argument("--save-dir", type=str, default="./data", 
                        help="Directory to save output GeoTIFFs (default: ./data)")
+    parser.add_argument("--max-workers", type=positive_int, default=MAX_WORKERS, 
+                       help=f"Number of concurrent tile downloads per month (default: {MAX_WORKERS})")
+    parser.add_argument("--jobs", type=positive_int, default=1, 
+                       help="Number of months to download in parallel processes (default: 1)")
+    parser.add_argument("--cache-dir", type=str, default=None, 
+                       help="Directory to cache downloaded tiles so reruns skip them")
+    parser.add_argument("--revalidate-cache", action="store_true", 
+                       help="Check cached tiles against the server (ETag) before reusing them")
     parser.add_argument("--dry-run", action="store_true", 
                        help="Print commands without executing")
     parser.add_argument("--continue-on-error", action="store_true", 
@@ -111,6 +204,9 @@ Examples:
     
     args = parser.parse_args()
     
+    if args.revalidate_cache and not args.cache_dir:
+        parser.error("--revalidate-cache requires --cache-dir")
+    
     # Validate AOI file exists
     if not os.path.exists(args.aoi):
         print(f"Error: AOI file not found: {args.aoi}", file=sys.stderr)
@@ -137,6 +233,10 @@ Examples:
     print(f"Total months: {len(months)}")
     print(f"Zoom level: {args.zoom}")
     print(f"Save directory: {args.save_dir}")
+    print(f"Parallel jobs: {args.jobs}")
+    print(f"Tile cache: {args.cache_dir or 'disabled'}")
+    if args.cache_dir:
+        print(f"Revalidate cache: {args.revalidate_cache}")
     # print(f"Dry run: {args.dry_run}")
     print(f"Continue on error: {args.continue_on_error}")
     print(f"Skip existing: {args.skip_existing}")
@@ -158,34 +258,57 @@ Examples:
         "skipped": []
     }
     
-    # Download each month
+    # Check which months already have an output, listing the save directory
+    # once rather than stat()-ing every expected file
+    existing_files = set()
+    if args.skip_existing:
+        with os.scandir(args.save_dir) as entries:
+            existing_files = {entry.name for entry in entries}
+    
+    pending = []
     for i, month in enumerate(months, 1):
-        # Check if output already exists
-        expected_output = os.path.join(args.save_dir, f"{aoi_basename}_{month}.tif")
+        output_name = f"{aoi_basename}_{month}.tif"
+        expected_output = os.path.join(args.save_dir, output_name)
         
-        if args.skip_existing and os.path.exists(expected_output):
+        if output_name in existing_files:
             print(f"\n[{i}/{len(months)}] Skipping {month} - output already exists: {expected_output}")
             results["skipped"].append(month)
             continue
         
-        print(f"\n[{i}/{len(months)}] Processing month: {month}")
+        pending.append(month)
+    
+    if args.jobs > 1:
+        run_downloader_parallel(pending, args, results)
+    else:
+        # Open the tile server connection pool once for all months
+        session = create_session(args.max_workers)
         
-        success, error = run_downloader(
-            aoi_path=args.aoi,
-            month=month,
-            api_key=args.api_key,
-            zoom=args.zoom,
-            save_dir=args.save_dir,
-            # dry_run=args.dry_run
-        )
+        # Download each month
+        for i, month in enumerate(pending, 1):
+            print(f"\n[{i}/{len(pending)}] Processing month: {month}")
+            
+            success, error = run_downloader(
+                aoi_path=args.aoi,
+                month=month,
+                api_key=args.api_key,
+                zoom=args.zoom,
+                save_dir=args.save_dir,
+                session=session,
+                max_workers=args.max_workers,
+                cache_dir=args.cache_dir,
+                revalidate_cache=args.revalidate_cache,
+                # dry_run=args.dry_run
+            )
+            
+            if success:
+                results["success"].append(month)
+            else:
+                results["failed"].append((month, error))
+                if not args.continue_on_error:
+                    print(f"\nStopping due to error. Use --continue-on-error to continue on failures.")
+                    break
         
-        if success:
-            results["success"].append(month)
-        else:
-            results["failed"].append((month, error))
-            if not args.continue_on_error:
-                print(f"\nStopping due to error. Use --continue-on-error to continue on failures.")
-                break
+        session.close()
     
     # Print summary
     print(f"\n{'='*60}")
@@ -1,159 +1,361 @@
 import os
+import math
 import argparse
+import functools
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import mercantile
 import geopandas as gpd
 import numpy as np
 import rasterio
-from rasterio.merge import merge
-from rasterio.transform import from_bounds
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from rasterio.windows import Window
 from tqdm import tqdm
-from PIL import Image
-from io import BytesIO
-from tempfile import TemporaryDirectory
+import imagecodecs
+from queue import Queue
+from tempfile import TemporaryFile
+from contextlib import nullcontext
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # ------------------------------
 MAX_WORKERS = 20
+TILE_SIZE = 256
+BLOCK_SIZE = 512
+OVERVIEW_FACTORS = [2, 4, 8, 16]
+GTIFF_OPTIONS = {
+    "tiled": True,
+    "blockxsize": BLOCK_SIZE,
+    "blockysize": BLOCK_SIZE,
+    "compress": "ZSTD",
+    "zstd_level": 3,
+    "predictor": 2,
+    "BIGTIFF": "IF_SAFER",
+}
+# GDAL block cache while writing. rasterio passes an integer GDAL_CACHEMAX
+# through as bytes, so this is 256 MB. It has to hold a full row of partly
+# written blocks, and build_overviews reads the whole image back through it.
+GDAL_WRITE_ENV = {
+    "GDAL_CACHEMAX": 256 * 1024 * 1024,
+    "GDAL_DISABLE_READDIR_ON_OPEN": "TRUE",
+}
 COORD = "{z}/{x}/{y}"
+EARTH_RADIUS = 6378137
 
-def download_and_save_tile(tile, session, tmpdir, tms_url):
+def positive_int(value):
+    """argparse type for options that must be at least 1"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
+
+def available_cpus():
+    # Respect CPU affinity (e.g. taskset, container cpusets) where the
+    # platform exposes it; os.cpu_count() reports every core on the host.
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def drop_page_cache(path):
+    # The output is written once and not read back by this process, so let
+    # the kernel evict its pages instead of holding them. DONTNEED starts
+    # writeback of dirty pages without waiting for it and drops clean ones.
+    # This is only a hint, so failures (e.g. on network filesystems) are
+    # ignored.
+    if not hasattr(os, "posix_fadvise"):
+        return
     try:
-        url = tms_url.format(z=tile.z, x=tile.x, y=tile.y)
-        response = session.get(url, timeout=15)
-        response.raise_for_status()
-        img = Image.open(BytesIO(response.content)).convert("RGB")
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
 
-        tile_bounds = mercantile.bounds(tile)
-        transform = from_bounds(tile_bounds.west, tile_bounds.south,
-                                tile_bounds.east, tile_bounds.north,
-                                img.width, img.height)
 
-        dst_path = os.path.join(tmpdir, f"{tile.z}_{tile.x}_{tile.y}.tif")
+def create_session(max_workers=MAX_WORKERS):
+    # Keep one warm keep-alive connection per worker thread so tiles don't
+    # pay a fresh TLS handshake whenever the default pool of 10 overflows.
+    retries = Retry(
+        total=5,
+        backoff_factor=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+    )
+    adapter = HTTPAdapter(
+        pool_connections=max_workers,
+        pool_maxsize=max_workers * 2,
+        max_retries=retries,
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    return session
+
+
+def decode_tile(data):
+    # Returns a (bands, rows, cols) view of the decoded buffer; the only
+    # copy is the one into the mosaic slice.
+    arr = imagecodecs.png_decode(data)
+    if arr.ndim == 2:
+        return np.broadcast_to(arr, (3,) + arr.shape)
+    if arr.shape[2] == 2:  # grey + alpha
+        return np.broadcast_to(arr[..., 0], (3,) + arr.shape[:2])
+    # Drop the alpha band of RGBA/palette tiles
+    return arr[..., :3].transpose(2, 0, 1)
+
+
+def write_cache_file(path, data):
+    # Write through a temporary name so an interrupted run never leaves a
+    # truncated entry behind in the cache
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def tile_cache_paths(cache_dir, tile):
+    tile_path = os.path.join(cache_dir, str(tile.z), str(tile.x), str(tile.y))
+    return f"{tile_path}.png", f"{tile_path}.etag"
+
+
+def discard_cache_entry(cache_dir, tile):
+    for path in tile_cache_paths(cache_dir, tile):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
 
-        with rasterio.open(
-            dst_path, "w",
-            driver="GTiff",
-            height=img.height,
-            width=img.width,
-            count=3,
-            dtype=rasterio.uint8,
-            crs="EPSG:4326",
-            transform=transform
-        ) as dst:
-            r, g, b = img.split()
-            dst.write(np.array(r), 1)
-            dst.write(np.array(g), 2)
-            dst.write(np.array(b), 3)
 
-        return dst_path
+def fetch_tile(tile, session, tms_url, cache_dir=None, revalidate=False):
+    cache_path = etag_path = cached = None
+    headers = {}
+    if cache_dir:
+        cache_path, etag_path = tile_cache_paths(cache_dir, tile)
+        if os.path.exists(cache_path):
+            with open(cache_path, "rb") as f:
+                cached = f.read()
+            if not revalidate:
+                return cached
+            # Ask the server to confirm the cached copy is current; a 304
+            # costs a few hundred bytes instead of the whole tile.
+            if os.path.exists(etag_path):
+                with open(etag_path, "r") as f:
+                    headers["If-None-Match"] = f.read()
 
+    url = tms_url.format(z=tile.z, x=tile.x, y=tile.y)
+    # Read the body straight off the socket in one call instead of letting
+    # requests assemble response.content from 10 KiB chunks
+    with session.get(url, timeout=15, stream=True, headers=headers) as response:
+        if response.status_code == 304 and cached is not None:
+            return cached
+        response.raise_for_status()
+        data = response.raw.read(decode_content=True)
+        etag = response.headers.get("ETag")
+
+    if cache_path:
+        write_cache_file(cache_path, data)
+        if etag:
+            write_cache_file(etag_path, etag.encode())
+        elif os.path.exists(etag_path):
+            # An ETag left over from the previous copy no longer matches
+            os.remove(etag_path)
+
+    return data
+
+
+def download_tile(tile, session, tms_url, tile_queue, cache_dir=None, revalidate=False):
+    try:
+        data = fetch_tile(tile, session, tms_url, cache_dir, revalidate)
     except Exception as e:
         print(f"Failed downloading tile {tile.z}/{tile.x}/{tile.y}: {e}")
-        return None
-    
-
-def merge_in_batches(paths, batch_size=500):
-    temp_outputs = []
-    with TemporaryDirectory() as tmpmerge:
-        for i in tqdm(range(0, len(paths), batch_size), desc="Merging batches"):
-            batch = paths[i:i + batch_size]
-            datasets = []
-            for path in batch:
-                try:
-                    datasets.append(rasterio.open(path))
-                except Exception as e:
-                    print(f"Error opening {path}: {e}")
-            if not datasets:
-                continue
-            mosaic, transform = merge(datasets)
-            for ds in datasets:
-                ds.close()
-
-            tmp_path = os.path.join(tmpmerge, f"batch_{i}.tif")
-            with rasterio.open(
-                tmp_path, "w",
-                driver="GTiff",
-                height=mosaic.shape[1],
-                width=mosaic.shape[2],
-                count=3,
-                dtype=mosaic.dtype,
-                crs="EPSG:4326",
-                transform=transform,
-            ) as dst:
-                dst.write(mosaic)
-            temp_outputs.append(tmp_path)
-
-        # Merge all batch mosaics to final
-        print("Merging final batches...")
-        final_datasets = [rasterio.open(p) for p in temp_outputs]
-        mosaic, transform = merge(final_datasets)
-        for ds in final_datasets:
-            ds.close()
-
-    return mosaic, transform
+        return False
 
+    # Blocks while the decode workers are behind, bounding the number of
+    # downloaded-but-undecoded tiles held in memory.
+    tile_queue.put((tile, data))
+    return True
+
+
+def place_tiles(tile_queue, mosaic, xmin, ymin, cache_dir=None):
+    """Decode queued tiles into the mosaic until a None sentinel arrives.
+
+    Tiles that fail to decode are removed from ``cache_dir`` so the next
+    run downloads them again. Returns the number of tiles placed.
+    """
+    placed = 0
+    while True:
+        item = tile_queue.get()
+        if item is None:
+            return placed
+
+        tile, data = item
+        try:
+            arr = decode_tile(data)
+
+            # Every tile owns a disjoint slice of the mosaic, so workers can
+            # write into it concurrently without locking.
+            row = (tile.y - ymin) * TILE_SIZE
+            col = (tile.x - xmin) * TILE_SIZE
+            mosaic[:, row:row + TILE_SIZE, col:col + TILE_SIZE] = arr
+            placed += 1
+
+        except Exception as e:
+            print(f"Failed decoding tile {tile.z}/{tile.x}/{tile.y}: {e}")
+            if cache_dir:
+                discard_cache_entry(cache_dir, tile)
+
+
+def tiles_for_bounds(bounds, zoom):
+    return tuple(mercantile.tiles(bounds[0], bounds[1], bounds[2], bounds[3], zoom))
+
+
+@functools.lru_cache(maxsize=8)
+def load_tiles(aoi, zoom):
+    # The AOI's tiles don't depend on the month, so batch runs read the
+    # GeoJSON and enumerate tiles only once per (aoi, zoom).
+    gdf = gpd.read_file(aoi)
+    return tiles_for_bounds(gdf.total_bounds, zoom)
 
-def main():
-    parser = argparse.ArgumentParser(description="Download PlanetScope tiles and merge to GeoTIFF")
-    parser.add_argument("--aoi", type=str, required=True, help="Path to AOI GeoJSON")
-    parser.add_argument("--month", type=str, required=True, help="Month of mosaic (YYYY_MM)")
-    parser.add_argument("--save-dir", type=str, default="./data", help="Directory to save output GeoTIFF")
-    parser.add_argument("--zoom", type=int, default=15, help="Zoom level for tiles")
-    parser.add_argument("--output-name", type=str, default=None, help="Output GeoTIFF filename")
-    parser.add_argument("--api-key", type=str, required=True, help="Planet API key")
-    args = parser.parse_args()
 
-    GEOJSON_PATH = args.aoi
-    ZOOM = args.zoom
-    FILENAME = os.path.splitext(os.path.basename(GEOJSON_PATH))[0]
-    OUTPUT_GEOTIFF = os.path.join(args.save_dir, f"{FILENAME}_{args.month}.tif")
-    os.makedirs(args.save_dir, exist_ok=True)
+def run(aoi, month, api_key, zoom, save_dir, output_name=None, session=None, gdf=None,
+        max_workers=MAX_WORKERS, cache_dir=None, revalidate_cache=False,
+        decode_workers=None):
+    """Download one month's mosaic for the AOI and return the output path.
 
-    TMS_URL = f"https://tiles.planet.com/basemaps/v1/planet-tiles/global_monthly_{args.month}_mosaic/gmap/{COORD}.png?api_key={args.api_key}"
+    Pass an existing ``session`` to reuse it across calls, and ``gdf`` to
+    use an already loaded AOI instead of reading ``aoi``. With ``cache_dir``
+    set, raw tiles are kept under ``cache_dir/<month>/z/x/y.png`` and reused
+    by later runs instead of being downloaded again. ``revalidate_cache``
+    checks cached tiles against the server's ETag before reusing them.
+    ``decode_workers`` sets the number of PNG decode threads and GeoTIFF
+    encoding threads (default: all available CPUs).
+    Returns None if no tile could be downloaded.
+    """
+    FILENAME = os.path.splitext(os.path.basename(aoi))[0]
+    OUTPUT_GEOTIFF = os.path.join(save_dir, output_name or f"{FILENAME}_{month}.tif")
+    os.makedirs(save_dir, exist_ok=True)
 
-    gdf = gpd.read_file(GEOJSON_PATH)
-    bounds = gdf.total_bounds
-    tiles = list(mercantile.tiles(bounds[0], bounds[1], bounds[2], bounds[3], ZOOM))
+    TMS_URL = f"https://tiles.planet.com/basemaps/v1/planet-tiles/global_monthly_{month}_mosaic/gmap/{COORD}.png?api_key={api_key}"
+
+    if gdf is None:
+        tiles = load_tiles(aoi, zoom)
+    else:
+        tiles = tiles_for_bounds(gdf.total_bounds, zoom)
 
     print(f"Total tiles: {len(tiles)}")
 
-    with TemporaryDirectory() as tmpdir, requests.Session() as session:
-        paths = []
+    month_cache_dir = os.path.join(cache_dir, month) if cache_dir else None
+
+    # Tiles at a fixed zoom share one pixel grid, so the mosaic is laid out
+    # by tile index instead of being merged from georeferenced pieces.
+    xmin = min(tile.x for tile in tiles)
+    xmax = max(tile.x for tile in tiles)
+    ymin = min(tile.y for tile in tiles)
+    ymax = max(tile.y for tile in tiles)
+    height = (ymax - ymin + 1) * TILE_SIZE
+    width = (xmax - xmin + 1) * TILE_SIZE
+
+    # Tiles are on the Web Mercator grid, so one north-up transform in
+    # EPSG:3857 georeferences the whole mosaic without any resampling.
+    ul_bounds = mercantile.xy_bounds(xmin, ymin, zoom)
+    resolution = 2 * math.pi * EARTH_RADIUS / (TILE_SIZE * 2 ** zoom)
+    out_trans = from_origin(ul_bounds.left, ul_bounds.top, resolution, resolution)
+
+    decode_workers = decode_workers or available_cpus()
+
+    session_ctx = nullcontext(session) if session is not None else create_session(max_workers)
+
+    with session_ctx as session, TemporaryFile(dir=save_dir) as buffer:
+        mosaic = np.memmap(buffer, dtype=np.uint8, mode="w+", shape=(3, height, width))
+
+        # Downloads and decodes run in separate pools joined by a bounded
+        # queue, so slow responses don't hold up tiles that are already here.
+        tile_queue = Queue(maxsize=max_workers * 2)
+
+        with ThreadPoolExecutor(max_workers=decode_workers) as decoders:
+            placers = [
+                decoders.submit(place_tiles, tile_queue, mosaic, xmin, ymin, month_cache_dir)
+                for _ in range(decode_workers)
+            ]
+
+            try:
+                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    futures = {
+                        executor.submit(download_tile, tile, session, TMS_URL, tile_queue,
+                                        month_cache_dir, revalidate_cache): tile
+                        for tile in tiles
+                    }
 
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            futures = {executor.submit(download_and_save_tile, tile, session, tmpdir, TMS_URL): tile for tile in tiles}
+                    for future in tqdm(as_completed(futures), total=len(futures), desc="Downloading tiles"):
+                        future.result()
+            finally:
+                for _ in placers:
+                    tile_queue.put(None)
 
-            for future in tqdm(as_completed(futures), total=len(futures), desc="Downloading tiles"):
-                result = future.result()
-                if result:
-                    paths.append(result)
+            downloaded = sum(placer.result() for placer in placers)
 
-        if not paths:
+        if not downloaded:
             print("No images downloaded.")
-            return
+            return None
 
-        print("Merging tiles...")
+        print("Saving mosaic...")
 
-        try:
-            mosaic, out_trans = merge_in_batches(paths)
-
-            with rasterio.open(
-                OUTPUT_GEOTIFF, "w",
-                driver="GTiff",
-                height=mosaic.shape[1],
-                width=mosaic.shape[2],
-                count=3,
-                dtype=mosaic.dtype,
-                crs="EPSG:4326",
-                transform=out_trans,
-            ) as dst:
-                dst.write(mosaic)
-
-            print(f"✅ Saved output to {OUTPUT_GEOTIFF}")
+        with rasterio.Env(**GDAL_WRITE_ENV), rasterio.open(
+            OUTPUT_GEOTIFF, "w",
+            driver="GTiff",
+            height=height,
+            width=width,
+            count=3,
+            dtype=mosaic.dtype,
+            crs="EPSG:3857",
+            transform=out_trans,
+            num_threads=decode_workers,
+            **GTIFF_OPTIONS,
+        ) as dst:
+            # Stream the memmap out one row of blocks at a time so GDAL can
+            # compress and flush each strip while only that strip is resident.
+            for row in range(0, height, BLOCK_SIZE):
+                rows = min(BLOCK_SIZE, height - row)
+                dst.write(mosaic[:, row:row + rows], window=Window(0, row, width, rows))
+            dst.build_overviews(OVERVIEW_FACTORS, Resampling.average)
+            dst.update_tags(ns="rio_overview", resampling="average")
 
-        except Exception as e:
-            print(f"Error during merging or saving: {e}")
+    drop_page_cache(OUTPUT_GEOTIFF)
+    print(f"✅ Saved output to {OUTPUT_GEOTIFF}")
+    return OUTPUT_GEOTIFF
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Download PlanetScope tiles and merge to GeoTIFF")
+    parser.add_argument("--aoi", type=str, required=True, help="Path to AOI GeoJSON")
+    parser.add_argument("--month", type=str, required=True, help="Month of mosaic (YYYY_MM)")
+    parser.add_argument("--save-dir", type=str, default="./data", help="Directory to save output GeoTIFF")
+    parser.add_argument("--zoom", type=int, default=15, help="Zoom level for tiles")
+    parser.add_argument("--output-name", type=str, default=None, help="Output GeoTIFF filename")
+    parser.add_argument("--api-key", type=str, required=True, help="Planet API key")
+    parser.add_argument("--max-workers", type=positive_int, default=MAX_WORKERS, help="Number of concurrent tile downloads")
+    parser.add_argument("--cache-dir", type=str, default=None, help="Directory to cache downloaded tiles for reruns")
+    parser.add_argument("--revalidate-cache", action="store_true", help="Check cached tiles against the server (ETag) before reusing them")
+    args = parser.parse_args()
+
+    if args.revalidate_cache and not args.cache_dir:
+        parser.error("--revalidate-cache requires --cache-dir")
+
+    run(
+        aoi=args.aoi,
+        month=args.month,
+        api_key=args.api_key,
+        zoom=args.zoom,
+        save_dir=args.save_dir,
+        output_name=args.output_name,
+        max_workers=args.max_workers,
+        cache_dir=args.cache_dir,
+        revalidate_cache=args.revalidate_cache,
+    )
 
 
 if __name__ == "__main__":